@@ -1,34 +1,89 @@
+from __future__ import annotations
+
 import os
 import sys
-import math
 import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-
-import pandas as pd
-import yfinance as yf
-
-
-def month_end_series(series: pd.Series) -> pd.Series:
-    """Daily -> month-end series (pandas >= 2.2 uses 'ME')."""
-    s = series.dropna()
-    if s.empty:
-        return s
-    s.index = pd.to_datetime(s.index)
-    return s.resample("ME").last().dropna()
+from typing import TYPE_CHECKING
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # optional speed-up; stdlib json parses the same documents
+    from json import loads as json_loads
+
+# pandas/requests are imported inside the functions that use them: they dominate cold start,
+# and a misconfigured run should fail before paying for them.
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+    import requests
+
+CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{ticker}"
+# Yahoo rejects the default python-requests User-Agent.
+HTTP_HEADERS = {"User-Agent": "Mozilla/5.0"}
+# Reruns within the hour (debugging, retries) are served from this SQLite file.
+HTTP_CACHE = ".http_cache"
+HTTP_CACHE_TTL = 3600
+TELEGRAM_URL = "https://api.telegram.org/bot{token}/sendMessage"
+TELEGRAM_RETRIES = 3
+CACHE_DIR = ".cache"
+# Re-download a few days already in the cache so the last (possibly partial) rows get refreshed.
+CACHE_OVERLAP_DAYS = 7
+# Relative tolerance when checking those overlap rows against the cache.
+CACHE_RTOL = 1e-4
+# Month-end offsets (0 = latest) read by the scores: 6M uses 0/6, 12-1 uses 1/13.
+ANCHOR_OFFSETS = (0, 1, 6, 13)
+# Daily history fetched and cached: comfortably covers the oldest anchor (~300 trading days).
+HISTORY_YEARS = 2
+
+
+def anchor_prices(prices: dict[str, pd.Series], offsets=ANCHOR_OFFSETS) -> pd.DataFrame:
+    """Month-end closes `offsets` months back from the latest month, one column per asset.
+
+    Each anchor is the last daily row on or before that month's end, found by binary search
+    on the sorted index instead of resampling the whole history. An asset with no row inside
+    an anchor month gets NaN there, as resample("ME").last() would.
+    """
+    import numpy as np
+    import pandas as pd
+
+    latest = max(s.index[-1] for s in prices.values()).to_period("M")
+    months = [latest - k for k in offsets]
+    starts = pd.DatetimeIndex([m.start_time for m in months])
+    # Search for the next month's first instant rather than Period.end_time: the latter has
+    # nanosecond precision, which cannot be compared against a second-resolution index.
+    next_starts = pd.DatetimeIndex([(m + 1).start_time for m in months])
+
+    columns = {}
+    for name, s in prices.items():
+        pos = s.index.searchsorted(next_starts, side="left") - 1
+        found = (pos >= 0) & (s.index[pos.clip(0)] >= starts)
+        columns[name] = np.where(found, s.to_numpy()[pos.clip(0)], np.nan)
+    return pd.DataFrame(columns, index=list(offsets))
+
+
+def total_return(anchors: np.ndarray, months: int, skip_last: int = 0) -> np.ndarray:
+    """Per-column total return over `months` month-ends; skip_last=1 implements classic 12-1 momentum.
+
+    `anchors` is an (anchor, asset) array whose rows follow ANCHOR_OFFSETS.
+    """
+    end = anchors[ANCHOR_OFFSETS.index(skip_last)]
+    start = anchors[ANCHOR_OFFSETS.index(skip_last + months)]
+    return (end / start) - 1.0
 
 
-def total_return(monthly_prices: pd.Series, months: int, skip_last: int = 0) -> float:
-    """Total return over `months` month-ends; skip_last=1 implements classic 12-1 momentum."""
-    needed = months + 1 + skip_last
-    if len(monthly_prices) < needed:
-        return float("nan")
-    end = monthly_prices.iloc[-1 - skip_last]
-    start = monthly_prices.iloc[-1 - skip_last - months]
-    return (end / start) - 1.0
+def score_all(anchors: np.ndarray):
+    """12-1 return, 6M return and the 50/50 GEM score for every asset column at once."""
+    r12_1 = total_return(anchors, 12, skip_last=1)
+    r6 = total_return(anchors, 6, skip_last=0)
+    return r12_1, r6, 0.5 * r12_1 + 0.5 * r6
 
 
 def fmt_pct(x: float) -> str:
-    if x is None or (isinstance(x, float) and (math.isnan(x) or math.isinf(x))):
+    if not math.isfinite(x):  # NaN, or inf from a zero start price
         return "n/a"
     return f"{x*100:.2f}%"
 
@@ -38,39 +93,164 @@ def load_env_json(name: str, default):
     if not raw:
         return default
     try:
-        return json.loads(raw)
+        return json_loads(raw)
     except json.JSONDecodeError as e:
         print(f"ERROR: {name} is not valid JSON: {e}")
         sys.exit(2)
 
 
-def extract_price_series(data: pd.DataFrame, preferred: str, ticker: str) -> pd.Series:
-    """Always return a 1D Series from yfinance output (handles MultiIndex/multi-ticker)."""
-    if data is None or data.empty:
-        raise ValueError("empty dataframe")
+def cache_path(ticker: str) -> str:
+    return os.path.join(CACHE_DIR, f"{ticker}.parquet")
 
-    if isinstance(data.columns, pd.MultiIndex):
-        level0 = data.columns.get_level_values(0)
-        key = preferred if preferred in level0 else ("Close" if "Close" in level0 else level0[0])
-        tmp = data[key]
-        if isinstance(tmp, pd.DataFrame):
-            s = tmp[ticker] if ticker in tmp.columns else tmp.iloc[:, 0]
-        else:
-            s = tmp
+
+def load_cached_prices(ticker: str) -> pd.Series:
+    """Daily prices stored by a previous run (empty Series when there is no usable cache)."""
+    import pandas as pd
+
+    path = cache_path(ticker)
+    if not os.path.exists(path):
+        return pd.Series(dtype="float64", index=pd.DatetimeIndex([]))
+    try:
+        return pd.read_parquet(path).iloc[:, 0]
+    except Exception as e:
+        print(f"WARNING: Ignoring unreadable cache {path}: {e}")
+        return pd.Series(dtype="float64", index=pd.DatetimeIndex([]))
+
+
+def save_cached_prices(ticker: str, series: pd.Series) -> None:
+    """Write via a temp file + os.replace so an interrupted run never leaves a torn cache."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = cache_path(ticker)
+    tmp = path + ".tmp"
+    series.rename("price").to_frame().to_parquet(tmp)
+    os.replace(tmp, path)
+
+
+def make_session() -> requests.Session:
+    try:
+        import requests_cache
+    except ImportError:  # optional: without it every run goes straight to Yahoo
+        import requests
+
+        session = requests.Session()
+    else:
+        session = requests_cache.CachedSession(HTTP_CACHE, expire_after=HTTP_CACHE_TTL)
+    session.headers.update(HTTP_HEADERS)
+    return session
+
+
+def fetch_prices(session: requests.Session, ticker: str, start: str, end: str) -> tuple[pd.Series, bool]:
+    """Daily adjusted closes in [start, end) straight from Yahoo's v8 chart API.
+
+    The flag is True when the window holds a dividend or split, after which Yahoo rescales
+    the whole adjusted history.
+    """
+    import pandas as pd
+
+    resp = session.get(
+        CHART_URL.format(ticker=ticker),
+        params={
+            "period1": int(pd.Timestamp(start, tz="UTC").timestamp()),
+            "period2": int(pd.Timestamp(end, tz="UTC").timestamp()),
+            "interval": "1d",
+            "events": "div,splits",
+        },
+        timeout=30,
+    )
+    resp.raise_for_status()
+    chart = json_loads(resp.content)["chart"]
+    if chart.get("error") or not chart.get("result"):
+        raise ValueError(chart.get("error") or "empty chart result")
+
+    result = chart["result"][0]
+    timestamps = result.get("timestamp")
+    if not timestamps:
+        return pd.Series(dtype="float64", index=pd.DatetimeIndex([])), False
+
+    indicators = result["indicators"]
+    adj = indicators.get("adjclose")
+    values = adj[0]["adjclose"] if adj else indicators["quote"][0]["close"]
+    # Bars are stamped at the session open; convert to exchange time so each lands on its own date.
+    tz = result["meta"].get("exchangeTimezoneName", "UTC")
+    index = pd.to_datetime(timestamps, unit="s", utc=True).tz_convert(tz).tz_localize(None).normalize()
+    events = result.get("events") or {}
+    rescaled = bool(events.get("dividends") or events.get("splits"))
+    return pd.Series(values, index=index, dtype="float64").dropna(), rescaled
+
+
+def cache_matches(cached: pd.Series, fresh: pd.Series) -> bool:
+    """True when `fresh` agrees with `cached` on the dates they share (and they share some)."""
+    import numpy as np
+
+    common = cached.index.intersection(fresh.index)
+    if common.empty:
+        return False
+    return bool(np.allclose(fresh.loc[common], cached.loc[common], rtol=CACHE_RTOL, atol=0))
+
+
+def load_prices(session: requests.Session, ticker: str, start: str, end: str) -> pd.Series:
+    """Cached daily prices from `start` on, topped up from Yahoo a few days before the cache ends."""
+    import pandas as pd
+
+    cached = load_cached_prices(ticker)
+    if cached.empty:
+        fetch_start = start
     else:
-        if preferred in data.columns:
-            s = data[preferred]
-        elif "Close" in data.columns:
-            s = data["Close"]
+        fetch_start = (cached.index[-1] - pd.Timedelta(days=CACHE_OVERLAP_DAYS)).strftime("%Y-%m-%d")
+        fetch_start = max(start, fetch_start)
+
+    series, rescaled = fetch_prices(session, ticker, fetch_start, end)
+    if not cached.empty:
+        if rescaled or not cache_matches(cached, series):
+            # Cached adjusted closes are on an old basis; mixing them in would fake a price jump.
+            print(f"WARNING: Adjusted history of {ticker} changed since it was cached, re-downloading.")
+            series, _ = fetch_prices(session, ticker, start, end)
         else:
-            s = data.iloc[:, 0]
+            series = pd.concat([cached, series])
+            series = series[~series.index.duplicated(keep="last")].sort_index()
+    # Older rows are never read; dropping them keeps the cache and every later step small.
+    series = series.loc[start:]
+    if not series.empty:
+        save_cached_prices(ticker, series)
+    return series
 
-    if isinstance(s, pd.DataFrame):
-        s = s.iloc[:, 0]
-    if not isinstance(s, pd.Series):
-        s = pd.Series(s)
 
-    return s
+def send_to_telegram(msg: str, token: str, chat_id: str) -> None:
+    """POST the alert to Telegram, retrying only transient failures with a growing pause.
+
+    Connection errors, timeouts, 429 and 5xx are retried; any other HTTP error (bad token,
+    unknown chat, message too long) will not go away by itself and fails immediately.
+    """
+    import requests
+
+    for attempt in range(1, TELEGRAM_RETRIES + 1):
+        try:
+            resp = requests.post(
+                TELEGRAM_URL.format(token=token),
+                data={"chat_id": chat_id, "text": msg, "disable_web_page_preview": "true"},
+                timeout=10,
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            # The bot token is part of the URL, keep it out of the logs.
+            err = str(e).replace(token, "***")
+        else:
+            if resp.ok:
+                return
+            try:
+                err = resp.json().get("description") or resp.text
+            except ValueError:
+                err = resp.text
+            err = f"HTTP {resp.status_code}: {err}".replace(token, "***")
+            if resp.status_code != 429 and resp.status_code < 500:
+                print(f"ERROR: Telegram rejected the alert: {err}")
+                sys.exit(1)
+
+        print(f"WARNING: Telegram send failed (attempt {attempt}/{TELEGRAM_RETRIES}): {err}")
+        if attempt < TELEGRAM_RETRIES:
+            time.sleep(2**attempt)
+
+    print("ERROR: Could not send the Telegram alert.")
+    sys.exit(1)
 
 
 def main():
@@ -91,50 +271,49 @@ def main():
         print(f"ERROR: GEM_BONDS_NAME '{bonds_name}' is not a key in GEM_TICKERS_JSON")
         sys.exit(2)
 
-    start = "2000-01-01"
-    end = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    today = datetime.now(timezone.utc)
+    start = today.replace(year=today.year - HISTORY_YEARS, day=1).strftime("%Y-%m-%d")
+    end = today.strftime("%Y-%m-%d")
 
-    monthly = {}
-    last_me_date = {}
+    session = make_session()
+    with ThreadPoolExecutor(max_workers=len(tickers)) as ex:
+        futures = {
+            name: ex.submit(load_prices, session, ticker, start, end)
+            for name, ticker in tickers.items()
+        }
 
+    prices = {}
+    last_me_date = {}
     for name, ticker in tickers.items():
-        data = yf.download(
-            ticker,
-            start=start,
-            end=end,
-            progress=False,
-            auto_adjust=False,
-            group_by="column",
-        )
-        if data is None or data.empty:
-            print(f"ERROR: No data for {name} ({ticker}). Check the Yahoo ticker.")
-            sys.exit(2)
-
         try:
-            series = extract_price_series(data, preferred="Adj Close", ticker=ticker)
+            series = futures[name].result()
         except Exception as e:
-            print(f"ERROR: Could not extract prices for {name} ({ticker}): {e}")
+            print(f"ERROR: Could not download prices for {name} ({ticker}): {e}")
             sys.exit(2)
-
-        me = month_end_series(series)
-        if me.empty:
-            print(f"ERROR: No month-end data for {name} ({ticker}).")
+        if series.empty:
+            print(f"ERROR: No price data for {name} ({ticker}). Check the Yahoo ticker.")
             sys.exit(2)
+        prices[name] = series
+        last_me_date[name] = str(series.index[-1].to_period("M").end_time.date())
+
+    anchors = anchor_prices(prices)
+    del prices
 
-        monthly[name] = me
-        last_me_date[name] = str(me.index[-1].date())
+    r12_1, r6, score = score_all(anchors.to_numpy(dtype="float64"))
+    details = {
+        name: {"r12_1": float(a), "r6": float(b), "score": float(c)}
+        for name, a, b, c in zip(anchors.columns, r12_1, r6, score)
+    }
 
-    details = {}
-    for name, series in monthly.items():
-        r12_1 = total_return(series, 12, skip_last=1)
-        r6 = total_return(series, 6, skip_last=0)
-        score = 0.5 * r12_1 + 0.5 * r6
-        details[name] = {"r12_1": float(r12_1), "r6": float(r6), "score": float(score)}
+    def rank_score(name: str) -> float:
+        # NaN compares false both ways and would scramble max()/sorted(); rank it (and inf) last.
+        score = details[name]["score"]
+        return score if math.isfinite(score) else float("-inf")
 
-    ranked = sorted(((n, details[n]["score"]) for n in risk_assets), key=lambda x: x[1], reverse=True)
-    top_name, top_score = ranked[0]
+    top_name = max(risk_assets, key=rank_score)
+    top_score = details[top_name]["score"]
 
-    if (top_score is None) or (isinstance(top_score, float) and math.isnan(top_score)) or top_score <= threshold:
+    if not math.isfinite(top_score) or top_score <= threshold:
         choice = bonds_name
         reason = f"RISK-OFF: best {top_name} = {fmt_pct(top_score)} <= {fmt_pct(threshold)}"
     else:
@@ -171,41 +350,40 @@ def main():
             f"KWOTA:       {capital_eur} EUR (100% kapitalu rotacyjnego)",
         ]
 
-    lines = []
-    lines.append("GEM SIGNAL (Classic 12-1 + 6M)")
-    lines.append(f"Time: {now_local}")
-    lines.append("")
-    lines.append("RANKING (risk assets):")
+    ranking_block = "\n".join(
+        f"{i}. {short_name(n)} | score {fmt_pct(details[n]['score'])} | "
+        f"12-1 {fmt_pct(details[n]['r12_1'])} | 6M {fmt_pct(details[n]['r6'])}"
+        for i, n in enumerate(sorted(risk_assets, key=rank_score, reverse=True), start=1)
+    )
+    trade_block = "\n".join(trade_lines)
+    bd = details[bonds_name]
 
-    for i, (n, _) in enumerate(ranked, start=1):
-        d = details[n]
-        lines.append(
-            f"{i}. {short_name(n)} | score {fmt_pct(d['score'])} | 12-1 {fmt_pct(d['r12_1'])} | 6M {fmt_pct(d['r6'])}"
-        )
+    msg = f"""GEM SIGNAL (Classic 12-1 + 6M)
+Time: {now_local}
 
-    lines.append("")
-    bd = details[bonds_name]
-    lines.append(
-        f"BONDS: {short_name(bonds_name)} | score {fmt_pct(bd['score'])} | 12-1 {fmt_pct(bd['r12_1'])} | 6M {fmt_pct(bd['r6'])}"
-    )
+RANKING (risk assets):
+{ranking_block}
 
-    lines.append("")
-    lines.append(f"ACTION: {action_title}")
-    for t in trade_lines:
-        lines.append(t)
+BONDS: {short_name(bonds_name)} | score {fmt_pct(bd['score'])} | 12-1 {fmt_pct(bd['r12_1'])} | 6M {fmt_pct(bd['r6'])}
 
-    lines.append("")
-    lines.append(f"Reason: {reason}")
-    lines.append("Rule: Top1 score > 0 => RISK-ON, else => BONDS (RISK-OFF)")
+ACTION: {action_title}
+{trade_block}
 
-    msg = "\n".join(lines)
+Reason: {reason}
+Rule: Top1 score > 0 => RISK-ON, else => BONDS (RISK-OFF)"""
 
     print("=== GEM MESSAGE START ===")
     print(msg)
     print("=== GEM MESSAGE END ===")
 
-    with open("gem_message.txt", "w", encoding="utf-8") as f:
-        f.write(msg)
+    token = os.environ.get("BOT_TOKEN", "").strip()
+    chat_id = os.environ.get("CHAT_ID", "").strip()
+    if token and chat_id:
+        send_to_telegram(msg, token, chat_id)
+    else:
+        # No Telegram credentials (e.g. a local run): leave the message on disk instead.
+        with open("gem_message.txt", "w", encoding="utf-8") as f:
+            f.write(msg)
 
 
 if __name__ == "__main__":